@@ -1,12 +1,28 @@
 import logging
 import os
+import sys
+import glob
+import tempfile
+import contextlib
+import shutil
 import asyncio
 import yt_dlp
-import math
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import re
+import json
+import copy
+import threading
+import httpx
+from concurrent.futures import ProcessPoolExecutor
+from cachetools import TTLCache
+from diskcache import Cache
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from yt_dlp.utils import DownloadError
+from yt_dlp.extractor.youtube import YoutubeIE
+from yt_dlp.extractor.youtube._base import INNERTUBE_CLIENTS
 
 # --- Configuration & Logging ---
 logging.basicConfig(
@@ -21,22 +37,317 @@ BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("No TELEGRAM_BOT_TOKEN found in environment variables.")
 
+# --- Webhook ---
+# When PUBLIC_URL is set, Telegram pushes updates to PUBLIC_URL/<token>
+# instead of the bot long-polling for them.
+PUBLIC_URL = os.environ.get("PUBLIC_URL", "").rstrip("/")
+PORT = int(os.environ.get("PORT", "8443"))
+
+# --- Metadata Cache ---
+# Trimmed yt-dlp info dicts keyed by video_id, so repeat pastes and the
+# download step don't pay for another extract_info round-trip.
+INFO_CACHE = TTLCache(maxsize=1024, ttl=900)
+FORMAT_FIELDS = ('format_id', 'ext', 'vcodec', 'acodec', 'height', 'tbr', 'abr', 'filesize', 'filesize_approx')
+# Audio containers we offer, most preferred last.
+AUDIO_EXT_PRIORITY = {'webm': 0, 'mp3': 1, 'm4a': 2}
+VIDEO_ID_RE = re.compile(
+    r'(?:^|\s)(?:https?://)?(?:(?:www|m|music)\.)?'
+    r'(?:youtube\.com/(?:watch\?(?:[^\s#]*&)?v=|shorts/|embed/|live/)|youtu\.be/)'
+    r'([0-9A-Za-z_-]{11})(?![0-9A-Za-z_-])'
+)
+
+# --- Telegram file_id Cache ---
+# Once a video/format has been uploaded, Telegram lets us resend it by file_id,
+# skipping the whole download + upload cycle. Persisted on disk, LRU-evicted.
+FILE_ID_CACHE = Cache('.file_id_cache', eviction_policy='least-recently-used', size_limit=64 * 1024 * 1024)
+FILE_ID_TTL = 30 * 24 * 60 * 60
+
+# --- yt-dlp Instances ---
+# Building a YoutubeDL loads extractors, cookies and network state, so one
+# long-lived instance is kept per distinct set of options.
+_YDL_POOL: dict[str, yt_dlp.YoutubeDL] = {}
+_YDL_POOL_LOCK = threading.Lock()
+# The bot only handles YouTube, so no other extractors are registered.
+ALLOWED_EXTRACTORS = ['youtube', 'youtube:tab']
+# The format listing only needs the player response: skip manifest probing,
+# subtitles and comments to keep extraction to as few requests as possible.
+INFO_YDL_OPTS = {
+    'quiet': True,
+    'skip_download': True,
+    'extract_flat': False,
+    'noplaylist': True,
+    'youtube_include_dash_manifest': False,
+    'youtube_include_hls_manifest': False,
+    'writesubtitles': False,
+    'getcomments': False,
+    'socket_timeout': 30,
+    'allowed_extractors': ALLOWED_EXTRACTORS,
+    # player_client is left at yt-dlp's defaults: those are the clients whose https
+    # formats work without a PO token, and the listing only uses https formats.
+    'extractor_args': {'youtube': {'skip': ['hls', 'dash', 'translated_subs']}},
+}
+
+# --- Worker Processes ---
+# Metadata extraction runs in worker processes so a slow or crashing
+# extractor can't stall the event loop; downloads already run as yt-dlp
+# subprocesses. Both are bounded by YDL_TIMEOUT seconds. A timed-out
+# extraction can't be cancelled inside its worker, so socket_timeout is
+# what keeps a stalled connection from holding a worker indefinitely.
+EXECUTOR = ProcessPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+YDL_TIMEOUT = 300
+
+# --- Download Limits ---
+MAX_CONCURRENT_DOWNLOADS = 3
+_GLOBAL_DOWNLOAD_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+_USER_SEMAPHORES: dict[int, asyncio.Semaphore] = {}
+
+# --- Download Spool ---
+# Downloads are written to RAM-backed /dev/shm when it has room for every
+# concurrent job, so the download and the read for upload don't hit the
+# disk. A merge keeps the video part, the audio part and the output on disk
+# at once; Docker's default 64 MB /dev/shm is far too small for that, so
+# such hosts fall back to the regular temp dir. SPOOL_DIR overrides both.
+SPOOL_BYTES_PER_JOB = 2 * 50 * 1024 * 1024
+
+def pick_spool_dir() -> str:
+    """Chooses where downloads are written: SPOOL_DIR, a roomy /dev/shm, or the temp dir."""
+    if os.environ.get("SPOOL_DIR"):
+        return os.environ["SPOOL_DIR"]
+    if os.path.isdir('/dev/shm') and shutil.disk_usage('/dev/shm').free >= MAX_CONCURRENT_DOWNLOADS * SPOOL_BYTES_PER_JOB:
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+SPOOL_DIR = pick_spool_dir()
+
+# --- Innertube ---
+# For the format listing, YouTube's own player endpoint returns all the
+# metadata we need in one small JSON response. yt-dlp is kept as the
+# fallback and for the downloads themselves (signature deciphering).
+# The client is yt-dlp's default JS-less client, taken from yt-dlp itself so
+# its version stays current across upgrades. It is also the client whose
+# formats yt-dlp downloads by default (web formats need a PO token), so the
+# heights and sizes on the buttons are ones the download can actually get.
+INNERTUBE_PLAYER_URL = "https://www.youtube.com/youtubei/v1/player?prettyPrint=false"
+INNERTUBE_CLIENT = INNERTUBE_CLIENTS[getattr(YoutubeIE, '_DEFAULT_JSLESS_CLIENTS', ('web',))[0]]
+INNERTUBE_CONTEXT = copy.deepcopy(INNERTUBE_CLIENT['INNERTUBE_CONTEXT'])
+INNERTUBE_HEADERS = {
+    'X-YouTube-Client-Name': str(INNERTUBE_CLIENT['INNERTUBE_CONTEXT_CLIENT_NAME']),
+    'X-YouTube-Client-Version': INNERTUBE_CONTEXT['client']['clientVersion'],
+}
+if INNERTUBE_CONTEXT['client'].get('userAgent'):
+    INNERTUBE_HEADERS['User-Agent'] = INNERTUBE_CONTEXT['client']['userAgent']
+INNERTUBE_TIMEOUT = 10
+_innertube_client: httpx.AsyncClient | None = None
+
 
 # --- Helper Functions ---
+SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+
 def format_size(size_bytes):
     """Converts bytes to a human-readable format (KB, MB, GB)."""
-    if size_bytes is None or size_bytes == 0:
+    if not size_bytes:
         return ""
-    size_name = ("B", "KB", "MB", "GB")
-    i = int(math.floor(math.log(size_bytes, 1024)))
-    p = pow(1024, i)
-    s = round(size_bytes / p, 2)
-    return f"({s} {size_name[i]})"
+    size_bytes = int(size_bytes)
+    # 1024 == 2**10, so the unit index is just the bit length in steps of 10.
+    i = min((size_bytes.bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+    s = round(size_bytes / (1 << (10 * i)), 2)
+    return f"({s} {SIZE_UNITS[i]})"
+
+# Same character set as telegram.helpers.escape_markdown(version=2), including the backslash itself.
+MARKDOWN_V2_ESCAPES = str.maketrans({char: f'\\{char}' for char in '\\' + r'_*[]()~`>#+-=|{}.!'})
 
 def escape_markdown_v2(text: str) -> str:
     """Escapes characters for Telegram's MarkdownV2 parse mode."""
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    return ''.join(f'\\{char}' if char in escape_chars else char for char in text)
+    return text.translate(MARKDOWN_V2_ESCAPES)
+
+def extract_video_id(url: str):
+    """Pulls the 11-character video id out of a YouTube URL, or None."""
+    match = VIDEO_ID_RE.search(url)
+    return match.group(1) if match else None
+
+def get_ydl(opts: dict) -> yt_dlp.YoutubeDL:
+    """Returns the shared YoutubeDL instance for these options, creating it on first use."""
+    key = json.dumps(opts, sort_keys=True)
+    with _YDL_POOL_LOCK:
+        ydl = _YDL_POOL.get(key)
+        if ydl is None:
+            # YoutubeDL keeps the dict it is given and fills defaults (including sets)
+            # into it, so hand it a copy and leave the caller's options serialisable.
+            ydl = _YDL_POOL[key] = yt_dlp.YoutubeDL(copy.deepcopy(opts))
+    return ydl
+
+def trim_info(info_dict: dict) -> dict:
+    """Keeps only the fields of a yt-dlp info dict that the bot actually uses."""
+    return {
+        'id': info_dict.get('id'),
+        'title': info_dict.get('title', 'No Title'),
+        'thumbnail': info_dict.get('thumbnail'),
+        'formats': [{k: f.get(k) for k in FORMAT_FIELDS} for f in info_dict.get('formats', [])],
+    }
+
+def extract_info_worker(url: str) -> dict:
+    """Runs in an EXECUTOR worker: extracts metadata and returns the trimmed info dict."""
+    try:
+        return trim_info(get_ydl(INFO_YDL_OPTS).extract_info(url, download=False))
+    except DownloadError as e:
+        # yt-dlp attaches exc_info and its logger, which can't be pickled back to the bot.
+        raise DownloadError(str(e)) from None
+
+def parse_innertube_format(f: dict) -> dict:
+    """Converts an Innertube streamingData format into the trimmed yt-dlp format shape."""
+    mime_type, _, codecs = f.get('mimeType', '').partition(';')
+    kind, _, subtype = mime_type.strip().partition('/')
+    codecs = [c.strip() for c in codecs.partition('=')[2].strip('" ').split(',') if c.strip()]
+    if kind == 'audio':
+        vcodec, acodec = 'none', codecs[0] if codecs else None
+    else:
+        vcodec = codecs[0] if codecs else None
+        acodec = codecs[1] if len(codecs) > 1 else 'none'
+    bitrate = (f.get('averageBitrate') or f.get('bitrate') or 0) / 1000
+    content_length = f.get('contentLength')
+    return {
+        'format_id': str(f.get('itag')),
+        'ext': 'm4a' if mime_type.strip() == 'audio/mp4' else subtype,
+        'vcodec': vcodec,
+        'acodec': acodec,
+        'height': f.get('height'),
+        'tbr': bitrate or None,
+        'abr': (bitrate or None) if kind == 'audio' else None,
+        'filesize': int(content_length) if content_length else None,
+        'filesize_approx': None,
+    }
+
+async def fetch_innertube_info(video_id: str):
+    """Fetches a trimmed info dict from the Innertube player endpoint, or None if it isn't usable."""
+    global _innertube_client
+    if _innertube_client is None:
+        # One keep-alive client for the whole process; it also keeps YouTube's cookies.
+        _innertube_client = httpx.AsyncClient(headers=INNERTUBE_HEADERS, timeout=INNERTUBE_TIMEOUT)
+    try:
+        response = await _innertube_client.post(INNERTUBE_PLAYER_URL, json={'context': INNERTUBE_CONTEXT, 'videoId': video_id})
+        response.raise_for_status()
+        player = response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        logger.warning(f"Innertube request failed for {video_id}: {e}")
+        return None
+
+    streaming_data = player.get('streamingData')
+    details = player.get('videoDetails') or {}
+    if player.get('playabilityStatus', {}).get('status') != 'OK' or not streaming_data:
+        return None
+    thumbnails = details.get('thumbnail', {}).get('thumbnails') or [{}]
+    raw_formats = streaming_data.get('formats', []) + streaming_data.get('adaptiveFormats', [])
+    return {
+        'id': details.get('videoId', video_id),
+        'title': details.get('title', 'No Title'),
+        'thumbnail': thumbnails[-1].get('url'),
+        'formats': [parse_innertube_format(f) for f in raw_formats],
+    }
+
+async def close_innertube_client(application: Application) -> None:
+    """post_shutdown hook: closes the shared Innertube HTTP client."""
+    global _innertube_client
+    if _innertube_client is not None:
+        await _innertube_client.aclose()
+        _innertube_client = None
+
+def pick_formats(formats: list) -> tuple:
+    """Single pass over formats: best mp4 video per height and the best audio-only format.
+
+    Per height, progressive mp4s (video with audio) win over video-only ones so
+    the download needs no ffmpeg merge; bitrate breaks ties.
+    """
+    best_by_height = {}
+    best_audio = None
+    best_audio_key = None
+    for f in formats:
+        vcodec = f.get('vcodec')
+        ext = f.get('ext')
+        if vcodec != 'none':
+            height = f.get('height')
+            if ext == 'mp4' and height:
+                current = best_by_height.get(height)
+                if current is None or (f.get('acodec') != 'none', f.get('tbr') or 0) > (current.get('acodec') != 'none', current.get('tbr') or 0):
+                    best_by_height[height] = f
+        elif f.get('acodec') != 'none' and ext in AUDIO_EXT_PRIORITY:
+            # yt-dlp lists formats worst to best, so later ones win ties.
+            key = (AUDIO_EXT_PRIORITY[ext], f.get('abr') or 0)
+            if best_audio_key is None or key >= best_audio_key:
+                best_audio, best_audio_key = f, key
+    return best_by_height, best_audio
+
+async def run_yt_dlp(args: list) -> bytes:
+    """Runs the yt-dlp CLI of this interpreter in a subprocess and returns its stdout."""
+    cmd = [sys.executable, '-m', 'yt_dlp', '--quiet', '--no-warnings', '--no-playlist', '--use-extractors', ','.join(ALLOWED_EXTRACTORS), *args]
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=YDL_TIMEOUT)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise DownloadError(f"yt-dlp timed out after {YDL_TIMEOUT}s")
+
+    if proc.returncode != 0 or not stdout:
+        raise DownloadError(stderr.decode(errors='replace').strip() or f"yt-dlp exited with code {proc.returncode}")
+    return stdout
+
+def read_file(path: str) -> bytes:
+    """Reads a whole file; called through asyncio.to_thread so it stays off the event loop."""
+    with open(path, 'rb') as f:
+        return f.read()
+
+async def download_media(url: str, download_format: str, download_type: str, file_base: str) -> tuple:
+    """Downloads the selected format and returns (media bytes, file extension)."""
+    # Both media types go through a real output file: yt-dlp skips its fixups
+    # (e.g. turning DASH m4a audio into a normal m4a) for stdout, and merging
+    # video+audio into a pipe would produce MPEG-TS instead of mp4. yt-dlp's
+    # merger already passes -movflags +faststart to ffmpeg, so the moov atom
+    # is up front for Telegram's streaming playback. yt-dlp prints the final
+    # path once done.
+    args = ['-f', download_format, '--force-overwrites', '-o', f"{file_base}.%(ext)s", '--no-simulate', '--print', 'after_move:filepath']
+    if download_type == 'video':
+        args += ['--merge-output-format', 'mp4']
+    stdout = await run_yt_dlp([*args, url])
+    file_path = stdout.decode().strip().splitlines()[-1]
+    return await asyncio.to_thread(read_file, file_path), os.path.splitext(file_path)[1]
+
+def remove_download_files(file_base: str) -> None:
+    """Deletes the merged file and any intermediate/partial files yt-dlp left for a download."""
+    for path in glob.glob(f"{glob.escape(file_base)}.*"):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+            logger.info(f"Cleaned up file: {path}")
+
+async def edit_caption_silently(query, caption: str) -> None:
+    """Edits a callback message's caption, ignoring failures (e.g. message unchanged)."""
+    try:
+        await query.edit_message_caption(caption=caption)
+    except Exception:
+        pass
+
+async def send_media(bot, chat_id, download_type: str, media, title: str):
+    """Sends audio or video (an InputFile or a cached file_id) and returns the sent Message."""
+    if download_type == 'audio':
+        return await bot.send_audio(chat_id=chat_id, audio=media, title=title, read_timeout=120, write_timeout=120)
+    return await bot.send_video(chat_id=chat_id, video=media, caption=title, supports_streaming=True, read_timeout=120, write_timeout=120)
+
+async def reply_with_formats(message, video_id: str, thumbnail_url, caption: str, reply_markup):
+    """Replies with the format picker, reusing the thumbnail's Telegram file_id when cached."""
+    thumbnail_key = f"{video_id}:thumbnail"
+    cached_thumbnail = FILE_ID_CACHE.get(thumbnail_key)
+    if cached_thumbnail:
+        try:
+            return await message.reply_photo(photo=cached_thumbnail, caption=caption, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
+        except BadRequest as e:
+            logger.warning(f"Cached thumbnail for {video_id} was rejected, using the URL again: {e}")
+            FILE_ID_CACHE.delete(thumbnail_key)
+
+    if not thumbnail_url:
+        return await message.reply_text(caption, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
+    sent = await message.reply_photo(photo=thumbnail_url, caption=caption, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
+    if sent.photo:
+        FILE_ID_CACHE.set(thumbnail_key, sent.photo[-1].file_id, expire=FILE_ID_TTL)
+    return sent
 
 
 # --- Command Handlers ---
@@ -54,51 +365,45 @@ async def url_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     processing_message = await update.message.reply_text("⏳ Processing link...")
 
     try:
-        ydl_opts = {'quiet': True, 'skip_download': True}
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info_dict = ydl.extract_info(url, download=False)
+        video_id = extract_video_id(url)
+        info_dict = INFO_CACHE.get(video_id) if video_id else None
+        if info_dict is None and video_id:
+            info_dict = await fetch_innertube_info(video_id)
+            if info_dict:
+                INFO_CACHE[video_id] = info_dict
+        if info_dict is None:
+            loop = asyncio.get_running_loop()
+            info_dict = await asyncio.wait_for(loop.run_in_executor(EXECUTOR, extract_info_worker, url), timeout=YDL_TIMEOUT)
+            video_id = info_dict['id']
+            INFO_CACHE[video_id] = info_dict
 
         title = info_dict.get('title', 'No Title')
-        context.user_data['video_title'] = title
         thumbnail_url = info_dict.get('thumbnail', None)
-        video_id = info_dict.get('id', None)
         formats = info_dict.get('formats', [])
         
-        keyboard = []
-        
+        best_by_height, best_audio = pick_formats(formats)
+
         # --- 1. VIDEO BUTTONS ---
-        video_formats = sorted(
-            [f for f in formats if f.get('vcodec') != 'none' and f.get('ext') == 'mp4' and f.get('height')],
-            key=lambda x: x.get('height', 0),
-            reverse=True
-        )
-        
-        added_resolutions = set()
-        for f in video_formats:
-            height = f.get('height')
-            if height and height not in added_resolutions:
-                added_resolutions.add(height)
-                file_size = f.get('filesize') or f.get('filesize_approx')
-                keyboard.append([InlineKeyboardButton(f"🎬 {height}p {format_size(file_size)}", callback_data=f"video:{video_id}:{height}")])
+        keyboard = [
+            [InlineKeyboardButton(f"🎬 {height}p {format_size(f['filesize'] or f['filesize_approx'])}", callback_data=f"video:{video_id}:{height}")]
+            for height, f in sorted(best_by_height.items(), reverse=True)
+        ]
 
         # --- 2. AUDIO BUTTON ---
-        best_audio = next((f for f in reversed(formats) if f.get('acodec') != 'none' and f.get('vcodec') == 'none' and f.get('ext') in ['m4a', 'webm', 'mp3']), None)
         if best_audio:
-            file_size = best_audio.get('filesize') or best_audio.get('filesize_approx')
+            file_size = best_audio['filesize'] or best_audio['filesize_approx']
             keyboard.append([InlineKeyboardButton(f"🎵 Audio {format_size(file_size)}", callback_data=f"audio:{video_id}:{best_audio['format_id']}")])
 
         if not keyboard:
             await processing_message.edit_text("Sorry, no suitable download formats were found.")
             return
 
+        delete_task = asyncio.create_task(processing_message.delete())
         reply_markup = InlineKeyboardMarkup(keyboard)
         caption = f"*{escape_markdown_v2(title)}*"
         
-        await processing_message.delete()
-        if thumbnail_url:
-            await update.message.reply_photo(photo=thumbnail_url, caption=caption, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            await update.message.reply_text(caption, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
+        reply = reply_with_formats(update.message, video_id, thumbnail_url, caption, reply_markup)
+        await asyncio.gather(delete_task, reply)
 
     except DownloadError as e:
         logger.error(f"yt-dlp DownloadError in url_handler: {e}")
@@ -122,56 +427,86 @@ async def download_button_callback(update: Update, context: ContextTypes.DEFAULT
     download_type, video_id, quality_or_id = query.data.split(':')
     url = f"https://www.youtube.com/watch?v={video_id}"
     
-    file_path = f"{query.from_user.id}_{video_id}.{'m4a' if download_type == 'audio' else 'mp4'}"
-    
-    try:
-        await query.edit_message_caption(caption="⏳ Preparing download...")
-    except Exception:
-        pass
+    file_base = os.path.join(SPOOL_DIR, f"{query.from_user.id}_{video_id}_{download_type}")
+    cache_key = f"{video_id}:{download_type}:{quality_or_id}"
+    # The title comes from the metadata cache rather than user_data, so it always matches the clicked video.
+    title = INFO_CACHE.get(video_id, {}).get('title', 'video')
+
+    cached_file_id = FILE_ID_CACHE.get(cache_key)
+    if cached_file_id:
+        try:
+            await send_media(context.bot, query.message.chat_id, download_type, cached_file_id, title)
+        except BadRequest as e:
+            logger.warning(f"Cached file_id for {cache_key} was rejected, downloading again: {e}")
+            FILE_ID_CACHE.delete(cache_key)
+        else:
+            # The media is already delivered; a picker we can't delete (e.g. older than 48h) is harmless.
+            try:
+                await query.message.delete()
+            except Exception:
+                pass
+            return
 
     download_format = quality_or_id
     if download_type == 'video':
         height = quality_or_id
-        download_format = f"bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/best[height<={height}][ext=mp4]/best"
-
-    ydl_opts = {
-        'format': download_format,
-        'outtmpl': file_path,
-        'quiet': True,
-        'noplaylist': True,
-        'merge_output_format': 'mp4',
-    }
+        # A progressive mp4 at the chosen height needs no merge; otherwise fall back to video+audio.
+        download_format = f"best[height={height}][ext=mp4][acodec!=none]/bestvideo[height<={height}][ext=mp4]+bestaudio[ext=m4a]/best[height<={height}][ext=mp4]/best"
+        # Pin the exact format we showed the user, so yt-dlp doesn't re-resolve the selector.
+        cached_info = INFO_CACHE.get(video_id)
+        if cached_info:
+            chosen = pick_formats(cached_info['formats'])[0].get(int(height))
+            if chosen:
+                if chosen.get('acodec') != 'none':
+                    download_format = f"{chosen['format_id']}/{download_format}"
+                else:
+                    download_format = f"{chosen['format_id']}+bestaudio[ext=m4a]/{download_format}"
 
-    try:
-        loop = asyncio.get_running_loop()
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            await loop.run_in_executor(None, ydl.download, [url])
+    # One download at a time per user, and at most MAX_CONCURRENT_DOWNLOADS overall.
+    current_semaphore = _USER_SEMAPHORES.get(query.from_user.id)
+    if (current_semaphore and current_semaphore.locked()) or _GLOBAL_DOWNLOAD_SEMAPHORE.locked():
+        await edit_caption_silently(query, "⏳ Queued, waiting for other downloads to finish...")
+
+    # Look the semaphore up only after the last await: from here until acquire()
+    # registers us as holder or waiter nothing yields, so the idle cleanup below
+    # can't drop a semaphore another task is about to use.
+    user_semaphore = _USER_SEMAPHORES.setdefault(query.from_user.id, asyncio.Semaphore(1))
+    async with user_semaphore, _GLOBAL_DOWNLOAD_SEMAPHORE:
+        # Let the status edit travel while yt-dlp is already starting up.
+        prepare_task = asyncio.create_task(edit_caption_silently(query, "⏳ Preparing download..."))
+
+        try:
+            media_bytes, file_ext = await download_media(url, download_format, download_type, file_base)
         
-        await query.edit_message_caption(caption="🚀 Uploading to Telegram...")
+            await prepare_task
+            await query.edit_message_caption(caption="🚀 Uploading to Telegram...")
         
-        title = context.user_data.get('video_title', 'video')
+            file_to_upload = InputFile(media_bytes, filename=f"{video_id}{file_ext}")
+            message = await send_media(context.bot, query.message.chat_id, download_type, file_to_upload, title)
 
-        with open(file_path, 'rb') as file_to_upload:
-            if download_type == 'audio':
-                await context.bot.send_audio(chat_id=query.message.chat_id, audio=file_to_upload, title=title, read_timeout=120, write_timeout=120)
-            else:
-                await context.bot.send_video(chat_id=query.message.chat_id, video=file_to_upload, caption=title, supports_streaming=True, read_timeout=120, write_timeout=120)
-        
-        await query.message.delete()
+            sent = message.audio if download_type == 'audio' else message.video
+            if sent:
+                FILE_ID_CACHE.set(cache_key, sent.file_id, expire=FILE_ID_TTL)
         
-    except DownloadError as e:
-        logger.error(f"Error during download (yt-dlp): {e}")
-        error_message = r"❌ *Download Failed*\n\nThis could be due to a YouTube error or a protected video\."
-        await query.edit_message_caption(caption=error_message, parse_mode=ParseMode.MARKDOWN_V2)
-    except Exception as e:
-        logger.error(f"Generic error during download: {e}")
-        error_message = r"❌ *An Unexpected Error Occurred*\n\nPlease try again later\."
-        await query.edit_message_caption(caption=error_message, parse_mode=ParseMode.MARKDOWN_V2)
+            await query.message.delete()
         
-    finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            logger.info(f"Cleaned up file: {file_path}")
+        except DownloadError as e:
+            logger.error(f"Error during download (yt-dlp): {e}")
+            INFO_CACHE.pop(video_id, None)
+            await prepare_task
+            error_message = r"❌ *Download Failed*\n\nThis could be due to a YouTube error or a protected video\."
+            await query.edit_message_caption(caption=error_message, parse_mode=ParseMode.MARKDOWN_V2)
+        except Exception as e:
+            logger.error(f"Generic error during download: {e}")
+            await prepare_task
+            error_message = r"❌ *An Unexpected Error Occurred*\n\nPlease try again later\."
+            await query.edit_message_caption(caption=error_message, parse_mode=ParseMode.MARKDOWN_V2)
+        finally:
+            remove_download_files(file_base)
+
+    # locked() also counts waiters, so this only drops semaphores nobody is queued on.
+    if not user_semaphore.locked() and _USER_SEMAPHORES.get(query.from_user.id) is user_semaphore:
+        del _USER_SEMAPHORES[query.from_user.id]
 
 def main() -> None:
     """Initializes and starts the bot."""
@@ -179,14 +514,23 @@ def main() -> None:
         logger.error("Bot token is not set in environment variables!")
         return
         
-    application = Application.builder().token(BOT_TOKEN).build()
+    # A larger keep-alive HTTP/2 pool lets concurrent uploads reuse connections
+    # instead of opening new TLS sessions; getUpdates keeps its own connection.
+    request = HTTPXRequest(connection_pool_size=64, http_version='2', read_timeout=120, write_timeout=120, pool_timeout=30)
+    get_updates_request = HTTPXRequest(http_version='2')
+
+    # Updates are handled concurrently; downloads are bounded by the semaphores above.
+    application = Application.builder().token(BOT_TOKEN).request(request).get_updates_request(get_updates_request).concurrent_updates(True).post_shutdown(close_innertube_client).build()
     
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, url_handler))
     application.add_handler(CallbackQueryHandler(download_button_callback))
     
     print("Bot is up and running...")
-    application.run_polling()
+    if PUBLIC_URL:
+        application.run_webhook(listen='0.0.0.0', port=PORT, url_path=BOT_TOKEN, webhook_url=f"{PUBLIC_URL}/{BOT_TOKEN}")
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()